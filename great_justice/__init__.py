@@ -24,11 +24,7 @@ def what_happen(logger=None):
     '''
     trace = utils.Trace(sys.exc_info())
     if not logger:
-        for info, indent in trace.stack:
-            lines = info.prettyformat().splitlines()
-            for line in lines:
-                print '  ' * indent + line
-            #pprint.pprint(unicode(trace))
+        utils.print_trace(trace)
     else:
         logger.log(unicode(trace))
 
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+'''
+asyncio-friendly versions of what_happen and take_your_time.
+
+The trace is captured on the event loop (exception info plus the current
+task's name and await chain) while rendering and delivery happen in an
+executor, so a slow formatter or handler does not stall other coroutines.
+Locals of frames that are still running are read when the trace gets
+rendered and may already hold newer values.
+'''
+
+import asyncio
+import functools
+import inspect
+import sys
+
+from . import utils
+
+__all__ = ['what_happen', 'take_your_time', 'get_task_info']
+
+_COROUTINE_FLAGS = (inspect.CO_COROUTINE | inspect.CO_ITERABLE_COROUTINE |
+                    inspect.CO_GENERATOR)
+
+
+def _current_task(loop):
+    try:
+        if hasattr(asyncio, 'current_task'):
+            return asyncio.current_task(loop=loop)
+        return asyncio.Task.current_task(loop=loop)
+    except RuntimeError:
+        # the loop is not running
+        return None
+
+def _location(frame):
+    filename = inspect.getsourcefile(frame) or frame.f_code.co_filename
+    return filename, frame.f_lineno, frame.f_code.co_name
+
+def get_task_info(task):
+    '''
+    Returns the task's name and its await chain as a list of
+    (filename, line no., scope) tuples, outermost first
+    '''
+    coro = task.get_coro() if hasattr(task, 'get_coro') else task._coro
+    if hasattr(task, 'get_name'):
+        name = task.get_name()
+    else:
+        name = getattr(coro, '__qualname__', repr(coro))
+    root = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+    # a running task's chain is the part of the call stack above its
+    # coroutine (cr_await is only set while suspended)
+    chain = []
+    frame = sys._getframe(1)
+    while frame is not None and frame is not root:
+        if frame.f_code.co_flags & _COROUTINE_FLAGS:
+            chain.append(frame)
+        frame = frame.f_back
+    if root is not None and frame is root:
+        chain.append(root)
+        chain.reverse()
+    else:
+        chain = []
+        while coro is not None:
+            frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+            if frame is None:
+                break
+            chain.append(frame)
+            coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return name, [_location(frame) for frame in chain]
+
+def _chain(source, destination, result=None):
+    '''
+    Complete destination when source is done, with source's error if any
+    or the given result
+    '''
+    def done(future):
+        if destination.cancelled():
+            return
+        if future.cancelled():
+            destination.cancel()
+        elif future.exception() is not None:
+            destination.set_exception(future.exception())
+        else:
+            destination.set_result(result)
+    source.add_done_callback(done)
+
+def _render(exc_info, task, logger, needs_text):
+    trace = utils.Trace(exc_info, task=task)
+    if not logger and not needs_text:
+        utils.print_trace(trace)
+        return None
+    text = unicode(trace)
+    if logger:
+        logger.error(text)
+    return text
+
+def _deliver(loop, exc_info, logger=None, handler=None, executor=None):
+    task = _current_task(loop)
+    task_info = get_task_info(task) if task is not None else None
+    rendered = loop.run_in_executor(
+        executor, functools.partial(_render, exc_info, task_info, logger,
+                                    handler is not None))
+    if handler is None:
+        return rendered
+    delivered = loop.create_future()
+    def call_handler(future):
+        if delivered.cancelled():
+            return
+        if future.cancelled() or future.exception() is not None:
+            _chain(future, delivered)
+            return
+        try:
+            result = handler(future.result())
+        except Exception as e: # pylint: disable=W0703
+            delivered.set_exception(e)
+            return
+        if inspect.isawaitable(result):
+            _chain(asyncio.ensure_future(result, loop=loop), delivered)
+        else:
+            delivered.set_result(None)
+    rendered.add_done_callback(call_handler)
+    return delivered
+
+def what_happen(logger=None, handler=None, loop=None, executor=None):
+    '''
+    Capture the current stack trace and return a future that is done once
+    it has been printed, logged or passed to handler
+
+    handler is called on the loop with the rendered text and may return
+    an awaitable; logging and printing run in the executor
+    '''
+    loop = loop or asyncio.get_event_loop()
+    return _deliver(loop, sys.exc_info(), logger=logger, handler=handler,
+                    executor=executor)
+
+
+class take_your_time(object):
+    '''
+    Asynchronous context manager trapping errors occuring inside it and
+    reporting them using what_happen before they propagate
+    '''
+    # pylint: disable=C0103,R0903
+
+    def __init__(self, logger=None, handler=None, loop=None, executor=None):
+        self.logger = logger
+        self.handler = handler
+        self.loop = loop
+        self.executor = executor
+
+    def _done(self, result):
+        future = (self.loop or asyncio.get_event_loop()).create_future()
+        future.set_result(result)
+        return future
+
+    def __aenter__(self):
+        return self._done(None)
+
+    def __aexit__(self, exc_type, exc_value, trace):
+        if exc_type is None or not issubclass(exc_type, Exception):
+            return self._done(False)
+        loop = self.loop or asyncio.get_event_loop()
+        delivered = _deliver(loop, (exc_type, exc_value, trace),
+                             logger=self.logger, handler=self.handler,
+                             executor=self.executor)
+        # never swallow the exception nor replace it with a delivery error
+        result = loop.create_future()
+        def done(future):
+            if not future.cancelled() and future.exception() is not None:
+                loop.call_exception_handler({
+                    'message': 'great_justice could not deliver a trace',
+                    'exception': future.exception()})
+            if not result.cancelled():
+                result.set_result(False)
+        delivered.add_done_callback(done)
+        return result
@@ -1,10 +1,13 @@
 from __future__ import absolute_import
 import argparse
+from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import formatdate
 from logging import Formatter, getLogger, StreamHandler
 from logging.handlers import SMTPHandler
+import gzip
+import io
 import os
 import smtplib
 import sys
@@ -16,6 +19,12 @@ from . import utils
 
 class Formatter(Formatter):
 
+    _max_trace_item_length = None
+
+    def _fragmentStyle(self):
+        # everything the rendering of a static trace fragment depends on
+        return type(self), self._max_trace_item_length
+
     def _formatTrace(self, trace):
         s = unicode(trace)
         if s[-1:] == "\n":
@@ -26,9 +35,25 @@ class Formatter(Formatter):
         trace = utils.Trace(ei)
         return self._formatTrace(trace)
 
+    def formatWithTrace(self, record, trace):
+        '''
+        Format the record using an already built (possibly summarized)
+        trace instead of the record's exc_info
+        '''
+        record.message = record.getMessage()
+        if self.usesTime():
+            record.asctime = self.formatTime(record, self.datefmt)
+        s = self._fmt % record.__dict__
+        if trace is not None:
+            if s[-1:] != "\n":
+                s = s + "\n"
+            s = s + self._formatTrace(trace)
+        return s
+
 
 class HtmlFormatter(Formatter):
 
+    class_prefix = 'gj-'
     header_container_style = 'white-space: pre-wrap; word-wrap: break-word;'
     trace_container_style = ('color:#fff;background:#000;font-size:14px;'
                              'font-family:monospace;white-space:pre;padding:10px')
@@ -36,27 +61,56 @@ class HtmlFormatter(Formatter):
         structure.WhatHappen: 'color:red',
         structure.VariableName: 'color:yellow',
         structure.Value: 'color:green',
+        structure.ValueReference: 'color:green;font-style:italic',
         structure.UndefinedValue: 'color:red',
         structure.CurrentLine: 'font-weight:bold;color:white',
         structure.CodeLine: 'font-weight:grey',
         structure.CodeScope: 'font-weight:bold',
         structure.CodeLineNo: 'font-weight:bold',
+        structure.FrameNo: 'font-weight:bold',
+        structure.TaskName: 'font-weight:bold',
         structure.ExceptionValue: 'font-weight:bold;color:red',
     }
 
     def __init__(self, *args, **kwargs):
         self._max_trace_item_length = kwargs.pop('max_trace_item_length', None)
+        # with inline_styles=False elements only get class names and
+        # stylesheet() has to be included in the document
+        self._inline_styles = kwargs.pop('inline_styles', True)
         super(Formatter, self).__init__(*args, **kwargs)
 
+    def _fragmentStyle(self):
+        return super(HtmlFormatter, self)._fragmentStyle() + (self._inline_styles,)
+
+    def _styleAttribute(self, name, style):
+        if self._inline_styles:
+            return 'style="%s"' % style
+        return 'class="%s%s"' % (self.class_prefix, name)
+
+    def stylesheet(self):
+        '''
+        CSS rules for the class names used when inline_styles is off
+        '''
+        rules = [('header', self.header_container_style),
+                 ('trace', self.trace_container_style)]
+        rules.extend(sorted((struct.__name__, style)
+                            for struct, style in self.styles.items()))
+        return '\n'.join('.%s%s {%s}' % (self.class_prefix, name, style)
+                         for name, style in rules)
 
     def format(self, record):
+        trace = utils.Trace(record.exc_info) if record.exc_info else None
+        return self.formatWithTrace(record, trace)
+
+    def formatWithTrace(self, record, trace):
         record.message = record.getMessage()
         if self.usesTime():
             record.asctime = self.formatTime(record, self.datefmt)
         s = self._fmt % record.__dict__
-        if record.exc_info:
-            exc_html = self.formatException(record.exc_info)
-            s = '<p style="%s">%s</p>' % (self.header_container_style, s)
+        if trace is not None:
+            exc_html = self._formatTrace(trace)
+            s = '<p %s>%s</p>' % (
+                self._styleAttribute('header', self.header_container_style), s)
             s = s + exc_html
         return s
 
@@ -73,53 +127,174 @@ class HtmlFormatter(Formatter):
                              .replace('<', '&lt;')
                              .replace("'", '&#39;')
                              .replace('"', '&#34;'))
-        output = ['<div style="%s">' % self.trace_container_style]
+        output = ['<div %s>' % self._styleAttribute('trace', self.trace_container_style)]
 
         def prettyformat(struct, indent):
             o = []
             def _prettyformat(struct):
+                cut = self._cutTraceItemString if struct.truncate else (lambda s: s)
                 if type(struct) in self.styles:
-                    o.append(u'<span style="%s">'% self.styles[type(struct)])
+                    o.append(u'<span %s>' % self._styleAttribute(type(struct).__name__,
+                                                                self.styles[type(struct)]))
                 for arg in struct.args:
                     if isinstance(arg, structure.Structure):
                         _prettyformat(arg)
                     elif isinstance(arg, basestring):
-                        o.append(self._cutTraceItemString(escape(structure._decode(arg))))
+                        o.append(cut(escape(structure._decode(arg))))
                     else:
-                        o.append(self._cutTraceItemString(escape(unicode(arg))))
+                        o.append(cut(escape(unicode(arg))))
                 if type(struct) in self.styles:
                     o.append(u'</span>')
             _prettyformat(struct)
             i = u'  '*indent
             return u'\n'.join([i+l for l in ''.join(o).splitlines()])
+        style = self._fragmentStyle()
         for struct, indent in trace.stack:
-            output.append(prettyformat(struct, indent))
+            output.append(utils.render_fragment(struct, indent, style, prettyformat))
         output.append('</div>')
         return '\n'.join(output)
 
 
 class SMTPHandler(SMTPHandler):
 
+    attachment_name = 'trace.txt.gz'
+    default_max_message_size = 1024 * 1024
+
     def __init__(self, *args, **kwargs):
         formatter = kwargs.pop('formatter', Formatter())
-        self.html_formatter = kwargs.pop('html_formatter', HtmlFormatter())
+        # summary=True keeps only the frame list and the innermost frame in
+        # the body and attaches the complete text trace gzip-compressed
+        self.summary = kwargs.pop('summary', False)
+        self.html_formatter = kwargs.pop('html_formatter',
+                                         HtmlFormatter(inline_styles=not self.summary))
+        # upper bound (in bytes) of the encoded message, parts get dropped
+        # or truncated to fit; None turns the limit off
+        self.max_message_size = kwargs.pop('max_message_size',
+                                           self.default_max_message_size)
         super(SMTPHandler, self).__init__(*args, **kwargs)
         self.formatter = formatter
 
+    def _html(self, body):
+        head = ''
+        if not getattr(self.html_formatter, '_inline_styles', True):
+            head = '<style type="text/css">\n%s\n</style>' % self.html_formatter.stylesheet()
+        return '<html><head>%s</head><body>%s</body></html>' % (head, body)
+
+    def _formatWithTrace(self, formatter, record, trace):
+        # plain logging formatters know nothing about our traces
+        if hasattr(formatter, 'formatWithTrace'):
+            return formatter.formatWithTrace(record, trace)
+        return formatter.format(record)
+
+    def _encode(self, text):
+        return text.encode(sys.getfilesystemencoding())
+
+    def _attachment(self, data):
+        attachment = MIMEApplication(data, 'gzip')
+        attachment.add_header('Content-Disposition', 'attachment',
+                              filename=self.attachment_name)
+        return attachment
+
+    def _compressedTrace(self, text):
+        buf = io.BytesIO()
+        compressed = gzip.GzipFile(filename=self.attachment_name[:-3], mode='wb',
+                                   fileobj=buf)
+        compressed.write(text.encode('utf-8'))
+        compressed.close()
+        return self._attachment(buf.getvalue())
+
+    def _composeMessage(self, record, text, html=None, attachment=None):
+        msg = MIMEMultipart('alternative')
+        msg.attach(MIMEText(self._encode(text), 'plain'))
+        if html is not None:
+            msg.attach(MIMEText(self._encode(html), 'html'))
+        if attachment is not None:
+            body, msg = msg, MIMEMultipart('mixed')
+            msg.attach(body)
+            msg.attach(attachment)
+        msg['Subject'] = self.getSubject(record)
+        msg['From'] = self.fromaddr
+        msg['To'] = ",".join(self.toaddrs)
+        msg['Date'] = formatdate()
+        return msg
+
+    def _estimateSize(self, record, text, html=None, attachment=None):
+        '''
+        Size of the serialized message: a skeleton with empty parts plus
+        the lengths of the encoded payloads
+        '''
+        skeleton = self._composeMessage(
+            record, u'', None if html is None else u'',
+            None if attachment is None else self._attachment(b''))
+        size = len(skeleton.as_string()) + len(self._encode(text))
+        if html is not None:
+            size += len(self._encode(html))
+        if attachment is not None:
+            size += len(attachment.get_payload())
+        return size
+
+    def _truncate(self, text, size):
+        '''
+        Cut text to at most size encoded bytes, from the middle so the
+        exception (last line) stays visible when there is room for it
+        '''
+        encoding = sys.getfilesystemencoding()
+        marker = u'\n...\n'
+        head, _, tail = text.rpartition(u'\n')
+        room = size - len(self._encode(marker + tail))
+        if room >= 0:
+            return self._encode(head)[:room].decode(encoding, 'ignore') + marker + tail
+        return self._encode(text)[:max(0, size)].decode(encoding, 'ignore')
+
+    def _limitMessage(self, record, text, html=None, attachment=None):
+        '''
+        Returns the serialized message, dropping the html part and
+        truncating the text until it fits in max_message_size; the
+        attachment is only dropped when the text cannot make enough room.
+        Raises ValueError if even the bare headers do not fit.
+        '''
+        limit = self.max_message_size
+        if limit is not None:
+            overflow = self._estimateSize(record, text, html, attachment) - limit
+            if overflow > 0 and html is not None:
+                html = None
+                overflow = self._estimateSize(record, text, html, attachment) - limit
+            if (overflow > 0 and attachment is not None and
+                overflow >= len(self._encode(text))):
+                attachment = None
+                text = u'[full trace dropped: message size limit exceeded]\n\n' + text
+                overflow = self._estimateSize(record, text, html, attachment) - limit
+            if overflow > 0:
+                text = self._truncate(text, len(self._encode(text)) - overflow)
+        msg = self._composeMessage(record, text, html, attachment).as_string()
+        # the estimate can be off by header folding and the like
+        while limit is not None and len(msg) > limit and text:
+            text = self._truncate(text, len(self._encode(text)) - (len(msg) - limit))
+            msg = self._composeMessage(record, text, html, attachment).as_string()
+        if limit is not None and len(msg) > limit:
+            raise ValueError('max_message_size of %d bytes cannot fit the message '
+                             'headers (%d bytes)' % (limit, len(msg)))
+        return msg
+
     def emit(self, record):
         try:
-            msg = MIMEMultipart('alternative')
-            msg['Subject'] = self.getSubject(record)
-            msg['From'] = self.fromaddr
-            msg['To'] = ",".join(self.toaddrs)
-            msg['Date'] = formatdate()
-
-            text = self.format(record)
-            msg.attach(MIMEText(text.encode(sys.getfilesystemencoding()), 'plain'))
-            if record.exc_info and self.html_formatter:
-                html =  self.html_formatter.format(record)
-                html = '<html><head></head><body>%s</body></html>' % html
-                msg.attach(MIMEText(html.encode(sys.getfilesystemencoding()), 'html'))
+            if self.summary and record.exc_info:
+                trace = utils.Trace(record.exc_info)
+                summary = trace.summary()
+                text = self._formatWithTrace(self.formatter, record, summary)
+                html = None
+                if self.html_formatter:
+                    html = self._html(self._formatWithTrace(self.html_formatter,
+                                                            record, summary))
+                attachment = self._compressedTrace(
+                    self._formatWithTrace(self.formatter, record, trace))
+                msg = self._limitMessage(record, text, html, attachment)
+            else:
+                text = self.format(record)
+                html = None
+                if record.exc_info and self.html_formatter:
+                    html = self._html(self.html_formatter.format(record))
+                msg = self._limitMessage(record, text, html)
             port = self.mailport
             if not port:
                 port = smtplib.SMTP_PORT
@@ -130,7 +305,7 @@ class SMTPHandler(SMTPHandler):
                     smtp.starttls(*self.secure)
                     smtp.ehlo()
                 smtp.login(self.username, self.password)
-            smtp.sendmail(self.fromaddr, self.toaddrs, msg.as_string())
+            smtp.sendmail(self.fromaddr, self.toaddrs, msg)
             smtp.quit()
         except (KeyboardInterrupt, SystemExit):
             raise
@@ -144,11 +319,14 @@ class TermFormatter(Formatter):
         structure.WhatHappen: {'color': 'red'},
         structure.VariableName: {'color': 'yellow'},
         structure.Value: {'color': 'green'},
+        structure.ValueReference: {'color': 'green', 'attrs': ['dark']},
         structure.UndefinedValue: {'color': 'red'},
         structure.CurrentLine: {'color': 'white', 'attrs': ['bold']},
         structure.CodeLine: {'color': 'blue'},
         structure.CodeScope: {'attrs': ['bold']},
         structure.CodeLineNo: {'attrs': ['bold']},
+        structure.FrameNo: {'attrs': ['bold']},
+        structure.TaskName: {'attrs': ['bold']},
         structure.ExceptionValue: {'color': 'red', 'attrs': ['reverse']}
     }
 
@@ -162,13 +340,16 @@ class TermFormatter(Formatter):
         def prettyformat(struct, indent):
             def _prettyformat(struct):
                 attrs = self.styles.get(type(struct), {})
+                cut = self._cutTraceItemString if struct.truncate else (lambda s: s)
                 return colored(
                     u''.join(_prettyformat(arg)
-                    if isinstance(arg, structure.Structure) else self._cutTraceItemString(unicode(arg))
+                    if isinstance(arg, structure.Structure) else cut(unicode(arg))
                     for arg in struct.args), **attrs)
             i = u'  '*indent
             return u'\n'.join([i+l for l in ''.join(_prettyformat(struct)).splitlines()])
-        return '\n'.join(prettyformat(info, indent) for info, indent in trace.stack)
+        style = self._fragmentStyle()
+        return '\n'.join(utils.render_fragment(info, indent, style, prettyformat)
+                         for info, indent in trace.stack)
 
     def _cutTraceItemString(self, element_string):
         if (self._max_trace_item_length is None or
@@ -179,12 +360,16 @@ class TermFormatter(Formatter):
 
 
     def format(self, record):
+        trace = utils.Trace(record.exc_info) if record.exc_info else None
+        return self.formatWithTrace(record, trace)
+
+    def formatWithTrace(self, record, trace):
         record.message = record.getMessage()
         if self.usesTime():
             record.asctime = self.formatTime(record, self.datefmt)
         s = self._fmt % record.__dict__
-        if record.exc_info:
-            exc_text = self.formatException(record.exc_info)
+        if trace is not None:
+            exc_text = self._formatTrace(trace)
             if s[-1:] != "\n":
                 s = s + "\n"
             try:
@@ -226,6 +411,11 @@ if __name__ == '__main__':
     mail_parser.add_argument('--username', required=False)
     mail_parser.add_argument('--password', required=False)
     mail_parser.add_argument('--unsecure', action='store_false')
+    mail_parser.add_argument('--summary', action='store_true',
+                             help='Send a summary and attach the full trace')
+    mail_parser.add_argument('--max-size', type=int,
+                             default=SMTPHandler.default_max_message_size,
+                             help='Message size limit in bytes')
 
     console_handler = StreamHandler(sys.stdout, formatter=Formatter(),
                                     term_formatter=TermFormatter())
@@ -235,7 +425,9 @@ if __name__ == '__main__':
         email_handler = SMTPHandler((args.host, args.port), args.fromaddr, [args.toaddress],
                                     args.subject, credentials=credentials,
                                     secure=None if args.unsecure else (),
-                                    formatter=Formatter(), html_formatter=HtmlFormatter())
+                                    formatter=Formatter(),
+                                    html_formatter=HtmlFormatter(inline_styles=not args.summary),
+                                    summary=args.summary, max_message_size=args.max_size)
         logger.addHandler(email_handler)
     mail_parser.set_defaults(func=add_email_handler)
 
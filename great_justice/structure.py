@@ -14,6 +14,11 @@ class Structure(object):
     '''
     # pylint: disable=R0903
     attrs = {}
+    # set on structures that depend only on the code location so their
+    # rendered form can be reused (see utils.render_fragment)
+    cache_key = None
+    # formatters may shorten the text of structures with this set
+    truncate = True
 
     def __init__(self, value):
         self.args = [value]
@@ -21,6 +26,10 @@ class Structure(object):
     def __unicode__(self):
         return u''.join(_decode(arg) for arg in self.args)
 
+    if sys.version_info[0] >= 3:
+        # 2to3 turns unicode(x) into str(x) but leaves __unicode__ alone
+        __str__ = __unicode__
+
     def prettyformat(self):
         '''
         The colorful version of __unicode__
@@ -89,6 +98,8 @@ class ShortVariable(Structure):
     # pylint: disable=R0903
     def __init__(self, variable_name, variable_value):
         # pylint: disable=W0231
+        self.variable_name = variable_name
+        self.value = variable_value
         self.args = [VariableName(variable_name),
                      u' = ',
                      Value(variable_value)]
@@ -105,6 +116,29 @@ class LongVariable(Structure):
                      u' = \\']
 
 
+class ValueReference(Structure):
+    '''
+    A pointer to a value already printed in another frame
+    '''
+    # pylint: disable=R0903
+    attrs = {'color': 'green', 'attrs': ['dark']}
+    truncate = False
+
+
+class SharedVariable(Structure):
+    '''
+    A variable whose value was already printed in another frame
+    '''
+    # pylint: disable=R0903
+    def __init__(self, variable_name, reference, value):
+        # pylint: disable=W0231
+        self.variable_name = variable_name
+        self.value = value
+        self.args = [VariableName(variable_name),
+                     u' = ',
+                     ValueReference(reference)]
+
+
 class UndefinedVariable(Structure):
     '''
     A variable we could not determine value of
@@ -183,6 +217,48 @@ class FileReference(Structure):
                      CodeScope(scope)]
 
 
+class TaskName(Structure):
+    '''
+    An asyncio task's name
+    '''
+    # pylint: disable=R0903
+    attrs = {'attrs': ['bold']}
+
+
+class TaskReference(Structure):
+    '''
+    The asyncio task the trace was captured in
+    '''
+    # pylint: disable=R0903
+    def __init__(self, name):
+        # pylint: disable=W0231
+        self.args = [u'Task ',
+                     TaskName(name),
+                     u', awaiting:']
+
+
+class FrameNo(Structure):
+    '''
+    The position of a frame in the trace
+    '''
+    # pylint: disable=R0903
+    attrs = {'attrs': ['bold']}
+
+
+class Frame(Structure):
+    '''
+    A numbered code reference
+    '''
+    # pylint: disable=R0903
+    def __init__(self, frame_no, file_reference):
+        # pylint: disable=W0231
+        self.args = [FrameNo(u'#%d' % frame_no),
+                     u' ',
+                     file_reference]
+        if file_reference.cache_key is not None:
+            self.cache_key = file_reference.cache_key + (frame_no,)
+
+
 class CodeLineNo(Structure):
     '''
     A line no. in code reference
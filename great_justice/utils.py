@@ -5,33 +5,100 @@ Helper utils
 '''
 
 import inspect
+import itertools
 import linecache
+import os
 import pprint
+import sys
+import threading
 import traceback
 
 from . import structure
 
 
+class LRUCache(object):
+    '''
+    A bounded, thread-safe mapping that forgets the least recently used keys
+    '''
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        # key -> [last use, value]; a plain dict keeps this working on 2.6
+        self._data = {}
+        self._uses = itertools.count()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            entry[0] = next(self._uses)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = [next(self._uses), value]
+            if len(self._data) > self.maxsize:
+                oldest = min(self._data, key=lambda k: self._data[k][0])
+                del self._data[oldest]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# (code, line no., source stamp) -> (FileReference, Code)
+static_structures = LRUCache(256)
+# (code, line no., source stamp, style, indent) -> rendered text
+rendered_fragments = LRUCache(1024)
+
+
 class Trace(object):
 
-    def __init__(self, exc_info):
+    # values whose pformat output spans lines or is longer than this are
+    # printed once per trace, later frames refer back to them
+    shared_value_length = 60
+
+    def __init__(self, exc_info, task=None):
         exc_type, exc_value, trace = exc_info
         self.stack = [(structure.WhatHappen(),0)]
+        # task is a (name, await chain) pair as returned by
+        # aio.get_task_info, chain entries are (filename, line no., scope)
+        self.task_stack = []
+        if task is not None:
+            name, chain = task
+            self.task_stack.append((structure.TaskReference(name), 0))
+            self.task_stack.extend((structure.FileReference(*location), 1)
+                                   for location in chain)
+            self.stack.extend(self.task_stack)
+        # id(value) -> (value, reference, pformat output) for large values
+        # already rendered in this trace; the value is kept to pin its id
+        self._rendered = {}
+        # (Frame, entries) for every frame, outermost first
+        self.frames = []
         while trace:
             frame = trace.tb_frame
             trace = trace.tb_next
             if not is_own_frame(frame):
-                filename = inspect.getsourcefile(frame)
-                self.stack.append((structure.FileReference(filename, frame.f_lineno, frame.f_code.co_name), 0))
-                self.stack.extend(self._parse_frame(frame))
+                file_reference, code = get_static_parts(frame)
+                header = structure.Frame(len(self.frames) + 1, file_reference)
+                entries = self._parse_frame(frame, code=code)
+                self.frames.append((header, entries))
+                self.stack.append((header, 0))
+                self.stack.extend(entries)
         self.stack.append((structure.ExceptionValue(''.join(traceback.format_exception_only(exc_type, exc_value)).strip()), 0))
 
-    def _parse_frame(self, frame, indent=0):
-        prefix, line, suffix = get_source(frame)
+    def _parse_frame(self, frame, indent=0, code=None):
+        if code is None:
+            code = get_static_parts(frame)[1]
         missing = object()
         stack = []
-        if line:
-            stack.append((structure.Code(prefix, line, suffix), indent+1))
+        if code:
+            stack.append((code, indent+1))
             for key in sorted(frame.f_code.co_varnames):
                 value = frame.f_locals.get(
                     key,
@@ -39,12 +106,23 @@ class Trace(object):
                          key,
                          frame.f_builtins.get(key, missing)))
                 if value is not missing:
+                    if id(value) in self._rendered:
+                        _obj, reference, rendered = self._rendered[id(value)]
+                        stack.append((structure.SharedVariable(key, reference, rendered),
+                                      indent+2))
+                        continue
+                    obj = value
                     try:
                         value = pprint.pformat(value, width=60)
                     except Exception: # pylint: disable=W0703
                         stack.append((structure.ShortVariable( key, '<EXCEPTION RAISED WHILE TRYING TO PRINT>'),
                                       indent+2))
                     else:
+                        if value.count('\n') or len(value) > self.shared_value_length:
+                            # the frame being parsed is appended right after
+                            self._rendered[id(obj)] = (
+                                obj, u'<same as %s in frame #%d>' % (key, len(self.frames) + 1),
+                                value)
                         if value.count('\n'):
                             stack.append((structure.LongVariable(key), indent+2))
                             stack.append((structure.Value(value), indent+3))
@@ -54,13 +132,57 @@ class Trace(object):
                     stack.append((structure.UndefinedVariable(key), indent+2))
         return stack
 
+    def summary(self, max_value_length=1000):
+        '''
+        Returns a shorter version of the trace listing all the frames
+        but showing code and variables of the innermost one only, with
+        values cut to max_value_length characters
+        '''
+        return TraceSummary(self, max_value_length=max_value_length)
+
     def __unicode__(self):
-        output = []
-        for info, indent in self.stack:
-            lines = unicode(info).splitlines()
-            for line in lines:
-                output.append('  ' * indent + line)
-        return '\n'.join(output)
+        def render(info, indent):
+            return u'\n'.join('  ' * indent + line
+                              for line in unicode(info).splitlines())
+        output = [render_fragment(info, indent, 'unicode', render)
+                  for info, indent in self.stack]
+        return '\n'.join(line for line in output if line)
+
+    if sys.version_info[0] >= 3:
+        __str__ = __unicode__
+
+
+class TraceSummary(Trace):
+
+    def __init__(self, trace, max_value_length=None):
+        # pylint: disable=W0231
+        def cut(value):
+            if max_value_length is None or len(value) <= max_value_length:
+                return value
+            return value[:max_value_length] + u'...'
+        self.frames = trace.frames[-1:]
+        self.task_stack = trace.task_stack
+        self.stack = [trace.stack[0]] + trace.task_stack
+        self.stack.extend((header, 0) for header, _ in trace.frames)
+        for header, entries in self.frames:
+            for info, indent in entries:
+                # the value this points to lives in a frame we skip
+                if isinstance(info, structure.SharedVariable):
+                    if info.value.count('\n'):
+                        self.stack.append((structure.LongVariable(info.variable_name), indent))
+                        self.stack.append((structure.Value(cut(info.value)), indent+1))
+                    else:
+                        self.stack.append((structure.ShortVariable(info.variable_name,
+                                                                   cut(info.value)), indent))
+                elif isinstance(info, structure.ShortVariable):
+                    self.stack.append((structure.ShortVariable(info.variable_name,
+                                                               cut(info.value)), indent))
+                elif type(info) is structure.Value:
+                    self.stack.append((structure.Value(cut(info.args[0])), indent))
+                else:
+                    self.stack.append((info, indent))
+        exception, indent = trace.stack[-1]
+        self.stack.append((structure.ExceptionValue(cut(exception.args[0])), indent))
 
 
 def is_own_frame(frame):
@@ -77,6 +199,52 @@ def is_own_frame(frame):
         return True
     return False
 
+def get_source_stamp(filename):
+    '''
+    Returns a value that changes whenever the given source file does
+    '''
+    try:
+        stat = os.stat(filename)
+    except (OSError, TypeError):
+        return None
+    return stat.st_mtime, stat.st_size
+
+def get_static_parts(frame):
+    '''
+    Returns the file reference and the code window (or None if the source
+    is unavailable) for the frame, reusing them for repeated code locations
+    '''
+    filename = inspect.getsourcefile(frame)
+    # code objects compare equal across files, so the filename is needed too
+    key = (filename, frame.f_code, frame.f_lineno, get_source_stamp(filename))
+    parts = static_structures.get(key)
+    if parts is None:
+        file_reference = structure.FileReference(filename, frame.f_lineno,
+                                                 frame.f_code.co_name)
+        file_reference.cache_key = key
+        prefix, line, suffix = get_source(frame)
+        code = None
+        if line:
+            code = structure.Code(prefix, line, suffix)
+            code.cache_key = key
+        parts = file_reference, code
+        static_structures.set(key, parts)
+    return parts
+
+def render_fragment(info, indent, style, render):
+    '''
+    Returns render(info, indent), served from cache for structures that
+    only depend on the code location (see Structure.cache_key)
+    '''
+    if info.cache_key is None:
+        return render(info, indent)
+    key = info.cache_key + (type(info), style, indent)
+    fragment = rendered_fragments.get(key)
+    if fragment is None:
+        fragment = render(info, indent)
+        rendered_fragments.set(key, fragment)
+    return fragment
+
 def get_source(obj):
     '''
     Get the source code for the frame object
@@ -92,6 +260,18 @@ def get_source(obj):
     return prefix, current, suffix
 
 
+def print_trace(trace):
+    '''
+    Print the colorful version of the trace
+    '''
+    def render(info, indent):
+        return u'\n'.join('  ' * indent + line
+                          for line in info.prettyformat().splitlines())
+    for info, indent in trace.stack:
+        fragment = render_fragment(info, indent, 'prettyformat', render)
+        if fragment:
+            print fragment
+
 def log(logger, info, indent=0):
     '''
     Either log a clean version of info or print its colorful version